@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 '''
 Python implementation of the INST evaluation measure, as described in:
 
@@ -37,8 +37,18 @@ optional arguments:
 '''
 
 import argparse
-from math import pow
+from collections import defaultdict
 import logging
+import sys
+
+import numpy as np
+from numba import njit, prange
+
+# Weight below which the INST recurrence stops early. With gains normalised to at most 1.0,
+# T_i >= T - i, so i + T + T_i >= 2T and each factor C_i = ((i+T+T_i-1)/(i+T+T_i))^2 lies in [0, 1).
+# W therefore never increases, and since sumW >= W_1 = 1, terms after W drops below this
+# cutoff cannot change the score by more than rounding error.
+W_CUTOFF = 1e-15
 
 def read_trec_results(trec_results_file):
     '''
@@ -47,13 +57,16 @@ def read_trec_results(trec_results_file):
     '''
     trec_results = {}
     with open(trec_results_file) as fh:
-        for line in fh:
-            try:
-                query, Q0, doc, rank, scoreStr, runid = line.strip().split()
-                trec_results[query] = trec_results.get(query, []) + [(doc, rank, float(scoreStr), runid)]
-            except Exception as e:
-                print ("Error: unable to split line in 6 parts", line)
-                raise e
+        try:
+            for line in fh:
+                query, Q0, doc, rank, scoreStr, runid = line.split()
+                # intern the ids so that repeated query and doc names share one string object
+                trec_results.setdefault(sys.intern(query), []).append((sys.intern(doc), rank, float(scoreStr), runid))
+        except UnicodeDecodeError: # raised while reading, not by a malformed line
+            raise
+        except ValueError: # a malformed line fails to unpack or convert
+            print("Error: unable to split line in 6 parts", line)
+            raise
     return trec_results
 
 def read_trec_qrels(trec_qrel_file):
@@ -63,15 +76,15 @@ def read_trec_qrels(trec_qrel_file):
     '''
     qrels = {}
     with open(trec_qrel_file) as fh:
-        for line in fh:
-            try:
-                query, zero, doc, relevance = line.strip().split()
-                docs = qrels.get(query, {})
-                docs[doc] = float(relevance)
-                qrels[query] = docs
-            except Exception as e:
-                print ("Error: unable to split line in 4 parts", line)
-                raise e
+        try:
+            for line in fh:
+                query, zero, doc, relevance = line.split()
+                qrels.setdefault(sys.intern(query), {})[sys.intern(doc)] = float(relevance)
+        except UnicodeDecodeError: # raised while reading, not by a malformed line
+            raise
+        except ValueError: # a malformed line fails to unpack or convert
+            print("Error: unable to split line in 4 parts", line)
+            raise
     return qrels
 
 def read_T_per_query(T_per_query_file):
@@ -81,13 +94,15 @@ def read_T_per_query(T_per_query_file):
     '''
     Ts = {}
     with open(T_per_query_file) as fh:
-        for line in fh:
-            try:
-                query, T = line.strip().split()
+        try:
+            for line in fh:
+                query, T = line.split()
                 Ts[query] = int(T)
-            except Exception as e:
-                print ("Error: unable to split line in 2 parts", line)
-                raise e
+        except UnicodeDecodeError: # raised while reading, not by a malformed line
+            raise
+        except ValueError: # a malformed line fails to unpack or convert
+            print("Error: unable to split line in 2 parts", line)
+            raise
     return Ts
 
 def find_max_graded_label(qrels):
@@ -95,53 +110,125 @@ def find_max_graded_label(qrels):
     Determine from the qrels what the maximum graded relevance label is.
     This will be used later bound turned graded labels to [0..1].
     '''
-    return max([rel for doc in qrels.values() for rel in doc.values()])
+    return max(rel for doc in qrels.values() for rel in doc.values())
 
-def inst_algorithm(T, ranked_gains, n, defaultValue):
+@njit('UniTuple(f8, 4)(i8, f8, f8, f8, f8, f8, f8)', cache=True, fastmath=True)
+def _inst_step(i, T, r_i, score, sumW, W_i, T_i):
     '''
-    Implementation of Algorithm 1 from Moffat et al, 2015.
+    Advance the recurrence of Algorithm 1 by one rank position.
+    '''
+    T_i = T_i - r_i
+    score = score + r_i * W_i
+    sumW = sumW + W_i
+
+    den = i + T + T_i
+    x = (den - 1.0) / den
+    W_i = W_i * x * x
+    return score, sumW, W_i, T_i
+
+@njit('UniTuple(i8, 2)(f8, f8[:], i8)', cache=True, fastmath=True)
+def _inst_bounds(T, ranked_gains, n):
+    '''
+    Return (maxN, depth): the number of rank positions to evaluate and how many of them come from the ranking.
+    '''
+    N = 20000 if T<=5 else 200000
+    return max(n,N), min(n, len(ranked_gains))
+
+@njit('Tuple((f8, f8, f8, f8, i8))(f8, f8[:], i8)', cache=True, fastmath=True)
+def _inst_prefix(T, ranked_gains, n):
+    '''
+    Run the recurrence over the leading judged items, which do not depend on defaultValue.
+    Returns the state (score, sumW, W_i, T_i, i) where i is the first rank not yet consumed.
     '''
     score = 0.0
-    N = int(2*pow(10,4) if T<=5 else 2*pow(10,5))
-    maxN = max(n,N)
-    W = [0]*(maxN+2) # the +2 is just to avoid having to check we don't compute the last W.[i+1]
-    C = [0]*(maxN+1) # the +1 is to allow us to use the rank positions from 1 .. N, rather than using a 0-base
+    maxN, depth = _inst_bounds(T, ranked_gains, n)
     sumW = 0.0
-    T_is = [0]*(maxN+1)
-    T_is[0] = T
-    W[1] = 1.0
+    T_i = float(T)
+    W_i = 1.0
+
+    i = 1
+    while i < maxN and i <= depth and ranked_gains[i-1] != -1:
+        score, sumW, W_i, T_i = _inst_step(i, T, ranked_gains[i-1], score, sumW, W_i, T_i)
+        i = i + 1
 
-    for i in range(1, maxN):
-        r_i = 0.0
+    return score, sumW, W_i, T_i, i
 
-        if i > n:
+@njit('f8(f8, f8[:], i8, f8, Tuple((f8, f8, f8, f8, i8)))', cache=True, fastmath=True)
+def _inst_tail(T, ranked_gains, n, defaultValue, prefix):
+    '''
+    Continue the recurrence from the state returned by _inst_prefix, filling in
+    unjudged items and ranks past the evaluation depth with defaultValue.
+    Stops early once the weights W have decayed below W_CUTOFF.
+    '''
+    score, sumW, W_i, T_i, start = prefix
+    maxN, depth = _inst_bounds(T, ranked_gains, n)
+
+    for i in range(start, maxN):
+        if W_i < W_CUTOFF:
+            break
+
+        if i > depth:
             r_i = defaultValue
         elif ranked_gains[i-1] == -1: # use -1.0 to indicate undefined values for items in the ranking
             r_i = defaultValue
         else:
             r_i = ranked_gains[i-1]
 
-        T_is[i] = T_is[i-1] - r_i
-        score = score + r_i * W[i]
-        sumW = sumW + W[i]
-
-        C[i] = pow((float(i) + T + T_is[i] - 1) / (float(i) + T + T_is[i]), 2)
-        W[i+1] = W[i] * C[i]
+        score, sumW, W_i, T_i = _inst_step(i, T, r_i, score, sumW, W_i, T_i)
 
     return score / sumW
 
+@njit('Tuple((f8, f8, i8))(f8, f8[:], i8)', cache=True, fastmath=True)
+def inst_query(T, ranked_gains, n):
+    '''
+    Compute (score_min, score_max, num_rel_ret) for one query.
+    The judged prefix of the ranking is shared by the min and max scores, so it is computed once.
+    '''
+    num_rel_ret = 0
+    for g in ranked_gains:
+        if g > 0.0:
+            num_rel_ret = num_rel_ret + 1
+
+    if len(ranked_gains) == 0: # assume score is 0.0000 if there are no results
+        return 0.0, 0.0, num_rel_ret
+
+    prefix = _inst_prefix(T, ranked_gains, n)
+    score_min = _inst_tail(T, ranked_gains, n, 0.0, prefix) # assume unjudged are all not relevant
+    score_max = _inst_tail(T, ranked_gains, n, 1.0, prefix) # assume unjudged are all relevant
+    return score_min, score_max, num_rel_ret
+
+def inst_algorithm(T, ranked_gains, n, defaultValue):
+    '''
+    Implementation of Algorithm 1 from Moffat et al, 2015.
+    ranked_gains must be a float64 NumPy array.
+    '''
+    return _inst_tail(T, ranked_gains, n, defaultValue, _inst_prefix(T, ranked_gains, n))
+
+@njit('Tuple((f8[:], f8[:], i8[:]))(f8[:], i8[:], f8[:], i8[:])', parallel=True, cache=True, fastmath=True)
+def inst_all_queries(gains_flat, offsets, Ts, ns):
+    '''
+    Compute the min and max INST scores and the number of relevant retrieved documents of every query in parallel.
+    The gains of query q are gains_flat[offsets[q]:offsets[q+1]].
+    '''
+    num_q = len(Ts)
+    scores_min = np.zeros(num_q)
+    scores_max = np.zeros(num_q)
+    num_rel_ret = np.zeros(num_q, dtype=np.int64)
+    for q in prange(num_q):
+        scores_min[q], scores_max[q], num_rel_ret[q] = inst_query(Ts[q], gains_flat[offsets[q]:offsets[q+1]], ns[q])
+    return scores_min, scores_max, num_rel_ret
 
 def calc_ranked_gains(ranked_list, qrels, max_graded_label):
     '''
-    Using qrels, turns a ranked list into array of gains.
+    Using qrels, turns a ranked list into a float64 NumPy array of gains.
     Note: unjudged documents are marked with gain of -1.0.
     '''
-    ranked_gains = []
-    for (doc, rank, score, runid) in ranked_list:
-        if doc in qrels:
-            ranked_gains.append(qrels[doc] / float(max_graded_label))
-        else:
-            ranked_gains.append(-1.0)
+    if max_graded_label <= 0:
+        raise ZeroDivisionError(f"maximum graded relevance label must be positive to scale gains, got {max_graded_label}")
+    ranked_gains = np.fromiter((qrels.get(doc, np.nan) for (doc, rank, score, runid) in ranked_list),
+                               dtype=np.float64, count=len(ranked_list))
+    ranked_gains /= max_graded_label
+    ranked_gains[np.isnan(ranked_gains)] = -1.0
     return ranked_gains
 
 def print_stats(num_ret, num_rel, num_rel_ret, score_min, score_max, residual, qId='all', num_q=0):
@@ -149,39 +236,46 @@ def print_stats(num_ret, num_rel, num_rel_ret, score_min, score_max, residual, q
     Print results in the same format as trec_eval.
     '''
     if num_q > 0:
-        print ("num_q\t\t%s\t%d" % (qId, num_q )    )
-    print ("num_ret\t\t%s\t%d" % (qId, num_ret ))
-    print ("num_rel\t\t%s\t%d" % (qId, num_rel ))
-    print ("num_rel_ret\t%s\t%d" % (qId, num_rel_ret))
-    print ("inst_min\t%s\t%.4f" % (qId, score_min))
-    print ("inst_max\t%s\t%.4f" % (qId, score_max))
-    print ("inst_res\t%s\t%.4f" % (qId, residual))
+        print(f"num_q\t\t{qId}\t{int(num_q)}")
+    print(f"num_ret\t\t{qId}\t{int(num_ret)}")
+    print(f"num_rel\t\t{qId}\t{int(num_rel)}")
+    print(f"num_rel_ret\t{qId}\t{int(num_rel_ret)}")
+    print(f"inst_min\t{qId}\t{score_min:.4f}")
+    print(f"inst_max\t{qId}\t{score_max:.4f}")
+    print(f"inst_res\t{qId}\t{residual:.4f}")
 
 def inst_eval(results, qrels, Ts, max_graded_label, complete_qrel_queries, eval_depth, per_query_result):
     '''
-    Main method that calls inst_algorithm for each query.
+    Main method that calls inst_all_queries for the evaluated queries.
     Accumulates and prints overall summary statistics.
     '''
-    totals = {}
+    totals = defaultdict(float)
+
+    # count the relevant documents of each query once, rather than each time the query is evaluated
+    num_rel_by_q = {query: sum(1 for rel in docs.values() if rel > 0.0) for (query, docs) in qrels.items()}
 
     query_list = sorted(qrels) if complete_qrel_queries else sorted(results)
 
-    query_count = 0
+    # gather the gains, T and depth of every query that can be evaluated, so they can be scored in one batch
+    evaluated = []
+    gains_list = []
+    T_list = []
+    n_list = []
     for qId in query_list:
         try:
             T = Ts[qId]
-        except KeyError as ke:
-            logging.error("No T was found for query %s." % qId) # logs to stderr
+        except KeyError:
+            logging.error("No T was found for query %s.", qId) # logs to stderr
             continue # skip this query and continue
 
         if qId not in qrels: # can't do anything if there are no qrels - skip this query
-            logging.error("No qrels were found for query %s." %  qId) # logs to stderr
+            logging.error("No qrels were found for query %s.", qId) # logs to stderr
             continue
 
         if qId in results or complete_qrel_queries: 
 
             if qId not in results:
-                logging.warn("No results found for query %s", qId)
+                logging.warning("No results found for query %s", qId)
                 results[qId] = []
 
             ranked_gains = calc_ranked_gains(results[qId], qrels[qId], max_graded_label)
@@ -191,35 +285,36 @@ def inst_eval(results, qrels, Ts, max_graded_label, complete_qrel_queries, eval_
             if eval_depth is None:
                 eval_depth = len(results[qId])
 
-            # get the scores - assume score is 0.0000 if there are no results
-            score_min = inst_algorithm(T, ranked_gains, eval_depth, 0.0) if len(ranked_gains) > 0 else 0.000 # assume unjudged are all not relevant
-            score_max = inst_algorithm(T, ranked_gains, eval_depth, 1.0) if len(ranked_gains) > 0 else 0.000 # assume unjudged are all relevant
-            
-
-            residual = score_max - score_min
+            evaluated.append((qId, len(results[qId]), num_rel_by_q[qId]))
+            gains_list.append(ranked_gains)
+            T_list.append(T)
+            n_list.append(eval_depth)
 
-            num_ret = len(results[qId])
-            num_rel = len([rel for rel in qrels[qId].values() if rel > 0.0])
-            num_rel_ret = len([g for g in ranked_gains if g > 0.0])
+        else: # there are no retrieval results for this query:
+            logging.error("No results were found for query %s.", qId) # logs to stderr
+            continue # skip this query and continue
 
-            if per_query_result:
-                print_stats(num_ret, num_rel, num_rel_ret, score_min, score_max, residual, qId)
+    offsets = np.zeros(len(gains_list) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(ranked_gains) for ranked_gains in gains_list])
+    gains_flat = np.concatenate(gains_list) if len(gains_list) > 0 else np.zeros(0)
+    scores_min, scores_max, num_rel_rets = inst_all_queries(gains_flat, offsets, np.array(T_list, dtype=np.float64), np.array(n_list, dtype=np.int64))
 
-            totals['num_ret'] = totals.get('num_ret', 0.0) + num_ret
-            totals['num_rel'] = totals.get('num_rel', 0.0) + num_rel
-            totals['num_rel_ret'] = totals.get('num_rel_ret', 0.0) + num_rel_ret
-            totals['score_min'] = totals.get('score_min', 0.0) + score_min
-            totals['score_max'] = totals.get('score_max', 0.0) + score_max
-            totals['residual'] = totals.get('residual', 0.0) + residual
+    for ((qId, num_ret, num_rel), score_min, score_max, num_rel_ret) in zip(evaluated, scores_min, scores_max, num_rel_rets):
+        residual = score_max - score_min
 
-            query_count = query_count + 1
+        if per_query_result:
+            print_stats(num_ret, num_rel, num_rel_ret, score_min, score_max, residual, qId)
 
-        else: # there are no retrieval results for this query:
-            logging.error("No results were found for query %s." %  qId) # logs to stderr
-            continue # skip this query and continue
+        totals['num_ret'] += num_ret
+        totals['num_rel'] += num_rel
+        totals['num_rel_ret'] += num_rel_ret
+        totals['score_min'] += score_min
+        totals['score_max'] += score_max
+        totals['residual'] += residual
 
+    query_count = len(evaluated)
     if len(totals) > 0:    
-        totals = dict([(stat, float(value)/query_count) for (stat, value) in totals.items()])
+        totals = {stat: float(value)/query_count for (stat, value) in totals.items()}
         totals['num_q'] = len(results)
         print_stats(**totals)
 
@@ -247,7 +342,7 @@ if __name__ == "__main__":
     if args.T_per_query is not None:
         Ts = read_T_per_query(args.T_per_query)
     elif args.over_write_T:
-        Ts = dict(zip(results.keys(), [args.over_write_T]*len(results))) # overwrite Ts to the supplied constant value
+        Ts = dict.fromkeys(results, args.over_write_T) # overwrite Ts to the supplied constant value
     else:
         logging.error("No T_per_query file or over_write_T found!")
     complete_qrel_queries = args.complete_qrel_queries